@@ -3,8 +3,11 @@ Flask RTSP Camera Viewer Application
 """
 from flask import Flask, render_template, Response, jsonify
 import logging
+import socket
+import threading
+import time
 from config import Config
-from utils.stream_handler import StreamHandler
+from utils.stream_handler import JPEG_ENCODER, StreamHandler
 
 # Configure logging
 logging.basicConfig(
@@ -21,15 +24,59 @@ app.config.from_object(Config)
 if not Config.load_cameras():
     logger.warning("Failed to load camera configurations")
 
-# Store active stream handlers
+# Store active stream handlers, guarded by stream_handlers_lock
 stream_handlers = {}
+stream_handlers_lock = threading.Lock()
+
+
+def create_stream_handler(stream, enable_motion):
+    """Create a stream handler from a StreamDescriptor"""
+    return StreamHandler(
+        stream.url,
+        jpeg_quality=stream.jpeg_quality,
+        timeout=stream.timeout,
+        retry_interval=stream.retry_interval,
+        enable_motion_detection=enable_motion,
+        motion_sensitivity=stream.motion_sensitivity,
+        motion_min_area=stream.motion_min_area,
+        capture_backend=stream.capture_backend,
+        hw_decoder=stream.hw_decoder,
+        codec=stream.codec,
+        drop_frames=stream.drop_frames,
+        max_fps=stream.max_fps,
+        target_width=stream.target_width,
+        motion_backend=stream.motion_backend,
+        motion_stride=stream.motion_stride,
+        motion_use_cuda=stream.motion_use_cuda
+    )
+
+
+def reap_idle_handlers():
+    """Periodically clean up stream handlers that have no viewers"""
+    while True:
+        time.sleep(Config.STREAM_REAP_INTERVAL)
+
+        now = time.monotonic()
+        idle = []
+        with stream_handlers_lock:
+            for stream_key, handler in list(stream_handlers.items()):
+                if now - handler.last_access > Config.STREAM_IDLE_TIMEOUT:
+                    idle.append((stream_key, stream_handlers.pop(stream_key)))
+
+        # Cleanup waits for the capture thread, so do it outside the lock
+        for stream_key, handler in idle:
+            logger.info(f"Releasing idle stream handler {stream_key}")
+            handler.cleanup()
+
+
+threading.Thread(target=reap_idle_handlers, daemon=True).start()
 
 
 @app.route('/')
 def index():
     """Main page displaying all camera streams"""
     cameras = []
-    for camera_id in sorted(Config.CAMERAS.keys()):
+    for camera_id in Config.CAMERA_IDS:
         camera_info = {
             'id': camera_id,
             'name': Config.get_camera_name(camera_id),
@@ -66,10 +113,10 @@ def video_feed(camera_id, quality):
     # Get motion detection parameter from query string
     enable_motion = request.args.get('motion', 'false').lower() == 'true'
 
-    # Get camera URL for specified quality
-    rtsp_url = Config.get_camera_url(camera_id, quality)
+    # Get resolved stream settings for specified quality
+    stream = Config.STREAMS.get((camera_id, quality))
 
-    if not rtsp_url:
+    if stream is None:
         logger.error(f"No URL configured for camera {camera_id}")
         return "Camera not configured", 404
 
@@ -77,39 +124,32 @@ def video_feed(camera_id, quality):
     stream_key = f"{camera_id}_{quality}"
 
     # Create or reuse stream handler
-    if stream_key not in stream_handlers:
-        logger.info(f"Creating new stream handler for camera {camera_id} ({quality})")
-        stream_handlers[stream_key] = StreamHandler(
-            rtsp_url,
-            jpeg_quality=Config.JPEG_QUALITY,
-            timeout=Config.STREAM_TIMEOUT,
-            retry_interval=Config.RETRY_INTERVAL,
-            enable_motion_detection=enable_motion,
-            motion_sensitivity=Config.MOTION_SENSITIVITY,
-            motion_min_area=Config.MOTION_MIN_AREA
-        )
-    else:
-        # Check if URL changed (in case of quality toggle)
-        current_url = stream_handlers[stream_key].rtsp_url
-        if current_url != rtsp_url:
+    stale_handler = None
+    with stream_handlers_lock:
+        handler = stream_handlers.get(stream_key)
+        if handler is None:
+            logger.info(f"Creating new stream handler for camera {camera_id} ({quality})")
+            handler = create_stream_handler(stream, enable_motion)
+            stream_handlers[stream_key] = handler
+        elif handler.rtsp_url != stream.url:
+            # URL changed (in case of quality toggle)
             logger.info(f"URL changed for camera {camera_id}, recreating handler")
-            stream_handlers[stream_key].cleanup()
-            stream_handlers[stream_key] = StreamHandler(
-                rtsp_url,
-                jpeg_quality=Config.JPEG_QUALITY,
-                timeout=Config.STREAM_TIMEOUT,
-                retry_interval=Config.RETRY_INTERVAL,
-                enable_motion_detection=enable_motion,
-                motion_sensitivity=Config.MOTION_SENSITIVITY,
-                motion_min_area=Config.MOTION_MIN_AREA
-            )
+            stale_handler = handler
+            handler = create_stream_handler(stream, enable_motion)
+            stream_handlers[stream_key] = handler
         else:
             # Just update motion detection state on existing handler
             logger.info(f"Toggling motion detection for camera {camera_id} to {enable_motion}")
-            stream_handlers[stream_key].set_motion_detection(enable_motion)
+            handler.set_motion_detection(enable_motion)
+
+        # Mark as in use so the reaper doesn't release it before streaming starts
+        handler.touch()
+
+    if stale_handler is not None:
+        stale_handler.cleanup()
 
     return Response(
-        stream_handlers[stream_key].generate_frames(),
+        handler.generate_frames(),
         mimetype='multipart/x-mixed-replace; boundary=frame'
     )
 
@@ -118,7 +158,7 @@ def video_feed(camera_id, quality):
 def get_cameras():
     """API endpoint to get camera information"""
     cameras = []
-    for camera_id in sorted(Config.CAMERAS.keys()):
+    for camera_id in Config.CAMERA_IDS:
         camera_info = {
             'id': camera_id,
             'name': Config.get_camera_name(camera_id),
@@ -138,8 +178,10 @@ def get_motion_status(camera_id, quality):
     # Use same stream key as video_feed (without motion state)
     stream_key = f"{camera_id}_{quality}"
 
-    if stream_key in stream_handlers:
-        handler = stream_handlers[stream_key]
+    with stream_handlers_lock:
+        handler = stream_handlers.get(stream_key)
+
+    if handler is not None:
         return jsonify({
             'camera_id': camera_id,
             'quality': quality,
@@ -165,24 +207,48 @@ def health():
 def cleanup():
     """Cleanup all stream handlers"""
     logger.info("Cleaning up stream handlers...")
-    for handler in stream_handlers.values():
+    with stream_handlers_lock:
+        handlers = list(stream_handlers.values())
+        stream_handlers.clear()
+    for handler in handlers:
         handler.cleanup()
-    stream_handlers.clear()
 
 
 if __name__ == '__main__':
     try:
         logger.info(f"Starting Flask app on port {Config.PORT}")
         logger.info(f"Debug mode: {Config.DEBUG}")
-        app.run(
-            host='0.0.0.0',
-            port=Config.PORT,
-            debug=Config.DEBUG,
-            threaded=True
-        )
+        logger.info(f"JPEG encoder: {JPEG_ENCODER}")
+        if Config.DEBUG:
+            # Werkzeug dev server, for the debugger and reloader
+            app.run(
+                host='0.0.0.0',
+                port=Config.PORT,
+                debug=True,
+                threaded=True
+            )
+        else:
+            # Production WSGI server; each MJPEG viewer holds a worker thread, so
+            # WAITRESS_THREADS caps concurrent viewers
+            from waitress.server import create_server
+            server = create_server(
+                app,
+                host='0.0.0.0',
+                port=Config.PORT,
+                threads=Config.WAITRESS_THREADS or max(16, 2 * 4 * len(Config.CAMERAS))
+            )
+            if Config.SOCKET_SNDBUF:
+                # Applied by waitress to every accepted connection (serve() doesn't take
+                # socket_options as a keyword). A fixed size turns off kernel autotuning
+                server.adj.socket_options = server.adj.socket_options + [
+                    (socket.SOL_SOCKET, socket.SO_SNDBUF, Config.SOCKET_SNDBUF)
+                ]
+            server.print_listen("Serving on http://{}:{}")
+            server.run()
     except KeyboardInterrupt:
         logger.info("Shutting down...")
-        cleanup()
     except Exception as e:
         logger.error(f"Error starting app: {e}")
+    finally:
+        # waitress handles Ctrl+C itself and returns from serve() normally
         cleanup()
@@ -1,10 +1,19 @@
 import os
 import json
+import functools
+from collections import namedtuple
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Resolved settings for one camera stream (camera + quality)
+StreamDescriptor = namedtuple('StreamDescriptor', [
+    'url', 'jpeg_quality', 'timeout', 'retry_interval', 'capture_backend', 'hw_decoder', 'codec',
+    'drop_frames', 'max_fps', 'target_width',
+    'motion_sensitivity', 'motion_min_area', 'motion_backend', 'motion_stride', 'motion_use_cuda'
+])
+
 class Config:
     """Application configuration"""
     
@@ -12,9 +21,13 @@ class Config:
     SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
     PORT = int(os.getenv('FLASK_PORT', 5000))
     DEBUG = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    WAITRESS_THREADS = int(os.getenv('WAITRESS_THREADS', 0))  # Max concurrent requests; each viewer holds one (0 = auto)
+    SOCKET_SNDBUF = int(os.getenv('SOCKET_SNDBUF', 0))  # Client socket send buffer in bytes (0 = OS default)
     
     # Camera configurations - loaded from JSON file
     CAMERAS = {}
+    CAMERA_IDS = ()  # Sorted camera IDs
+    STREAMS = {}  # StreamDescriptor keyed by (camera_id, quality)
     
     @staticmethod
     def load_cameras():
@@ -33,6 +46,9 @@ class Config:
                         'url': camera['url'],
                         'name': camera['name']
                     }
+            Config.CAMERA_IDS = tuple(sorted(Config.CAMERAS.keys()))
+            Config.get_camera_url.cache_clear()
+            Config.STREAMS = Config._build_streams()
             
             return True
         except FileNotFoundError:
@@ -49,13 +65,25 @@ class Config:
     JPEG_QUALITY = int(os.getenv('JPEG_QUALITY', 80))
     RETRY_INTERVAL = int(os.getenv('RETRY_INTERVAL', 5))
     STREAM_TIMEOUT = int(os.getenv('STREAM_TIMEOUT', 10))
+    CAPTURE_BACKEND = os.getenv('CAPTURE_BACKEND', 'opencv')  # opencv, pyav (encodes JPEG from YUV)
+    HW_DECODER = os.getenv('HW_DECODER', 'auto')  # auto, none, nvdec, vaapi, v4l2, cuvid
+    VIDEO_CODEC = os.getenv('VIDEO_CODEC', 'h264')  # h264, h265 (used by hardware decoders)
+    DROP_FRAMES = os.getenv('DROP_FRAMES', 'True').lower() == 'true'  # Skip stale frames when processing falls behind
+    MAX_FPS = int(os.getenv('MAX_FPS', 0))  # Cap encoded frame rate per stream (0 = source rate)
+    TARGET_WIDTH = int(os.getenv('TARGET_WIDTH', 0))  # Downscale wider frames before encoding (0 = source size)
+    STREAM_IDLE_TIMEOUT = int(os.getenv('STREAM_IDLE_TIMEOUT', 60))  # Release streams with no viewers after this many seconds
+    STREAM_REAP_INTERVAL = int(os.getenv('STREAM_REAP_INTERVAL', 30))  # Seconds between idle stream checks
 
     # Motion detection settings
     MOTION_DETECTION_ENABLED = os.getenv('MOTION_DETECTION_ENABLED', 'False').lower() == 'true'
     MOTION_SENSITIVITY = os.getenv('MOTION_SENSITIVITY', 'medium')  # low, medium, high
     MOTION_MIN_AREA = int(os.getenv('MOTION_MIN_AREA', 500))  # Minimum contour area in pixels
+    MOTION_BACKEND = os.getenv('MOTION_BACKEND', 'mog2')  # mog2, tempdiff
+    MOTION_STRIDE = int(os.getenv('MOTION_STRIDE', 3))  # Analyse every Nth frame
+    MOTION_USE_CUDA = os.getenv('MOTION_USE_CUDA', 'True').lower() == 'true'  # Use GPU for mog2 if OpenCV has CUDA
 
     @staticmethod
+    @functools.lru_cache(maxsize=16)
     def get_camera_url(camera_id, quality='main'):
         """Get camera URL with specified quality (main=ch0, sub=ch1)"""
         if camera_id not in Config.CAMERAS:
@@ -81,6 +109,34 @@ class Config:
         
         return base_url
     
+    @staticmethod
+    def _build_streams():
+        """Resolve URL and stream settings for every camera and quality"""
+        streams = {}
+        for camera_id in Config.CAMERA_IDS:
+            for quality in ('main', 'sub'):
+                url = Config.get_camera_url(camera_id, quality)
+                if not url:
+                    continue
+                streams[(camera_id, quality)] = StreamDescriptor(
+                    url=url,
+                    jpeg_quality=Config.JPEG_QUALITY,
+                    timeout=Config.STREAM_TIMEOUT,
+                    retry_interval=Config.RETRY_INTERVAL,
+                    capture_backend=Config.CAPTURE_BACKEND,
+                    hw_decoder=Config.HW_DECODER,
+                    codec=Config.VIDEO_CODEC,
+                    drop_frames=Config.DROP_FRAMES,
+                    max_fps=Config.MAX_FPS or None,
+                    target_width=Config.TARGET_WIDTH or None,
+                    motion_sensitivity=Config.MOTION_SENSITIVITY,
+                    motion_min_area=Config.MOTION_MIN_AREA,
+                    motion_backend=Config.MOTION_BACKEND,
+                    motion_stride=Config.MOTION_STRIDE,
+                    motion_use_cuda=Config.MOTION_USE_CUDA
+                )
+        return streams
+
     @staticmethod
     def get_camera_name(camera_id):
         """Get camera display name"""
@@ -2,17 +2,284 @@
 Stream handler for RTSP to MJPEG conversion
 """
 import cv2
+import functools
+import inspect
+import numpy as np
+import os
+import re
 import time
 import logging
-from threading import Lock
+from threading import Condition, Event, Lock, Thread
 
 logger = logging.getLogger(__name__)
 
+# Use libjpeg-turbo for JPEG encoding when available, otherwise cv2.imencode
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except ImportError as e:
+    logger.info(f"TurboJPEG unavailable, using OpenCV JPEG encoder: {e}")
+    turbo_jpeg = None
+except Exception as e:  # Library not found, or older than PyTurboJPEG supports
+    logger.warning(f"TurboJPEG failed to load, using OpenCV JPEG encoder: {e} "
+                   f"(PyTurboJPEG 2.x needs libjpeg-turbo 3.0+, PyTurboJPEG<2 works with 2.x)")
+    turbo_jpeg = None
+
+JPEG_ENCODER = 'libjpeg-turbo' if turbo_jpeg is not None else 'opencv'
+
+# PyTurboJPEG before 2.5 has no align argument and assumes 4-byte aligned YUV rows
+TURBO_YUV_ALIGN_ARG = (turbo_jpeg is not None and
+                       'align' in inspect.signature(turbo_jpeg.encode_from_yuv).parameters)
+
+# PyAV lets the pyav capture backend encode JPEGs straight from decoded YUV frames
+try:
+    import av
+except ImportError:
+    av = None
+
+CAPTURE_BACKENDS = ('opencv', 'pyav')
+
+# GStreamer decode stages for each supported hardware decoder ({codec} is h264 or h265)
+HW_DECODER_PIPELINES = {
+    'nvdec': 'nvv4l2decoder ! nvvidconv ! video/x-raw,format=BGRx',  # Jetson / NVIDIA
+    'vaapi': 'vaapi{codec}dec ! vaapipostproc',                       # Intel VAAPI
+    'v4l2': 'v4l2{codec}dec',                                          # Raspberry Pi v4l2 m2m
+}
+
+# Hardware acceleration requested per capture from OpenCV's FFmpeg backend
+FFMPEG_HW_DECODERS = {
+    'cuvid': cv2.VIDEO_ACCELERATION_ANY,  # NVIDIA NVDEC, or whatever FFmpeg device OpenCV finds
+}
+
+
+def _detect_hw_decoder():
+    """Detect which hardware decoder is available on this platform"""
+    try:
+        if not re.search(r'GStreamer:\s+YES', cv2.getBuildInformation()):
+            return None
+    except Exception:
+        return None
+
+    if os.path.exists('/etc/nv_tegra_release'):
+        return 'nvdec'
+
+    try:
+        with open('/proc/device-tree/model', 'r') as f:
+            if 'Raspberry Pi' in f.read():
+                return 'v4l2'
+    except OSError:
+        pass
+
+    if os.path.exists('/dev/dri/renderD128'):
+        return 'vaapi'
+
+    return None
+
+
+DETECTED_HW_DECODER = _detect_hw_decoder()
+
+
+def _cuda_device_count():
+    """Number of CUDA devices OpenCV can use (0 if OpenCV was built without CUDA)"""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount()
+    except Exception:
+        return 0
+
+
+CUDA_AVAILABLE = _cuda_device_count() > 0
+
+
+def resolve_hw_decoder(hw_decoder):
+    """Resolve a HW_DECODER setting (auto, none, nvdec, vaapi, v4l2, cuvid) to a decoder name or None"""
+    hw_decoder = (hw_decoder or 'none').lower()
+    if hw_decoder == 'auto':
+        return DETECTED_HW_DECODER
+    if hw_decoder in FFMPEG_HW_DECODERS:
+        if not re.search(r'FFMPEG:\s+YES', cv2.getBuildInformation()):
+            logger.warning(f"OpenCV was built without FFmpeg, '{hw_decoder}' unavailable")
+            return None
+        return hw_decoder
+    if hw_decoder in HW_DECODER_PIPELINES:
+        return hw_decoder
+    if hw_decoder != 'none':
+        logger.warning(f"Unknown hardware decoder '{hw_decoder}', using software decoding")
+    return None
+
+
+def build_gstreamer_pipeline(rtsp_url, hw_decoder, codec='h264'):
+    """Build a GStreamer pipeline that decodes an RTSP stream on the given hardware decoder"""
+    decoder = HW_DECODER_PIPELINES[hw_decoder].format(codec=codec)
+    # Quote the URL so credentials containing spaces or '!' don't break the pipeline parse
+    location = rtsp_url.replace('\\', '\\\\').replace('"', '\\"')
+    return (
+        f'rtspsrc location="{location}" latency=0 ! rtp{codec}depay ! {codec}parse ! '
+        f"{decoder} ! videoconvert ! video/x-raw,format=BGR ! "
+        "appsink drop=1 max-buffers=1"
+    )
+
+
+def open_ffmpeg_capture(rtsp_url, timeout=None, hw_acceleration=None):
+    """
+    Open a capture with OpenCV's FFmpeg backend
+
+    Args:
+        timeout: Seconds to wait for the stream to open (None for OpenCV's default)
+        hw_acceleration: cv2.VIDEO_ACCELERATION_* type to decode with (None for software)
+    """
+    # Both only take effect when passed to the constructor, and apply to this capture alone
+    params = []
+    if timeout:
+        params += [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(timeout * 1000)]
+    if hw_acceleration is not None:
+        params += [cv2.CAP_PROP_HW_ACCELERATION, hw_acceleration]
+    return cv2.VideoCapture(rtsp_url, cv2.CAP_FFMPEG, params)
+
+
+class PyAVCapture:
+    """
+    RTSP capture using PyAV, with the parts of the cv2.VideoCapture interface StreamHandler uses
+
+    read_jpeg() encodes the decoded YUV frame with TurboJPEG, or FFmpeg's MJPEG encoder
+    when TurboJPEG is unavailable, skipping the BGR conversion that read() needs.
+    """
+
+    def __init__(self, rtsp_url, timeout=10):
+        self._container = None
+        self._frames = None
+        self._frame = None
+        self._encoder = None
+        self._encoder_key = None
+        try:
+            self._container = av.open(rtsp_url, options={'rtsp_transport': 'tcp'}, timeout=timeout)
+            self._stream = self._container.streams.video[0]
+            self._stream.thread_type = 'AUTO'
+            self._frames = self._container.decode(self._stream)
+        except Exception as e:
+            # FFmpeg errors include the URL, so log only the reason to keep credentials out
+            logger.error(f"PyAV failed to open stream: {getattr(e, 'strerror', None) or type(e).__name__}")
+            self.release()
+
+    def isOpened(self):
+        return self._container is not None
+
+    def grab(self):
+        """Decode the next frame without converting it"""
+        try:
+            self._frame = next(self._frames)
+            return True
+        except (StopIteration, av.FFmpegError):
+            self._frame = None
+            return False
+
+    def retrieve(self):
+        """Convert the last grabbed frame to a BGR ndarray"""
+        if self._frame is None:
+            return False, None
+        return True, self._frame.to_ndarray(format='bgr24')
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def read_jpeg(self, jpeg_quality, target_width=None):
+        """
+        Decode the next frame and encode it as JPEG from YUV, returning (success, buffer)
+
+        Args:
+            target_width: Downscale wider frames to this width (in YUV, keeping the aspect ratio)
+        """
+        if not self.grab():
+            return False, None
+        frame = self._frame
+        width, height = frame.width, frame.height
+        if target_width and width > target_width:
+            width, height = target_width, target_width * height // width
+
+        # TurboJPEG compresses planar full-range 4:2:0 without a colorspace conversion;
+        # a single swscale pass does any range expansion and scaling it needs
+        if self._turbo_yuv_supported(width, height):
+            if (frame.width, frame.height, frame.format.name) != (width, height, 'yuvj420p'):
+                frame = frame.reformat(width=width, height=height, format='yuvj420p',
+                                       interpolation='AREA')
+            # to_ndarray() packs the planes without row padding
+            align = {'align': 1} if TURBO_YUV_ALIGN_ARG else {}
+            return True, turbo_jpeg.encode_from_yuv(frame.to_ndarray(), height, width,
+                                                    quality=jpeg_quality,
+                                                    jpeg_subsample=TJSAMP_420, **align)
+
+        if (frame.width, frame.height) != (width, height):
+            frame = frame.reformat(width=width, height=height, interpolation='AREA')
+        encoder = self._get_encoder(frame, jpeg_quality)
+        packets = encoder.encode(frame)
+        if not packets:
+            return False, None
+        return True, bytes(packets[0])
+
+    @staticmethod
+    def _turbo_yuv_supported(width, height):
+        """Whether TurboJPEG can encode a packed 4:2:0 frame of this size"""
+        if turbo_jpeg is None or width % 2 or height % 2:
+            return False
+        # Without align, packed chroma rows (width / 2 bytes) must already be 4-byte aligned
+        return TURBO_YUV_ALIGN_ARG or width % 8 == 0
+
+    def _get_encoder(self, frame, jpeg_quality):
+        """MJPEG encoder for the frame's size and pixel format, reused until either changes"""
+        # JPEG is full-range YUV: full-range decoder output is encoded as-is,
+        # limited-range output gets its range expanded by the encoder
+        pix_fmt = frame.format.name
+        if pix_fmt not in ('yuvj420p', 'yuvj422p', 'yuvj444p'):
+            pix_fmt = 'yuvj420p'
+        key = (frame.width, frame.height, pix_fmt, jpeg_quality)
+        if self._encoder_key != key:
+            encoder = av.CodecContext.create('mjpeg', 'w')
+            encoder.width = frame.width
+            encoder.height = frame.height
+            encoder.pix_fmt = pix_fmt
+            encoder.time_base = self._stream.time_base
+            # Map JPEG quality (1-100) onto FFmpeg's quantiser scale (31-2, lower is better)
+            encoder.qmin = encoder.qmax = round(2 + (100 - jpeg_quality) * 29 / 99)
+            self._encoder = encoder
+            self._encoder_key = key
+        return self._encoder
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS and self._container is not None:
+            return float(self._stream.average_rate or 0)
+        return 0.0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        if self._container is not None:
+            self._container.close()
+        self._container = None
+        self._frames = None
+        self._frame = None
+
 
 class MotionDetector:
-    """Handle motion detection using background subtraction"""
+    """Handle motion detection using background subtraction or temporal differencing"""
+
+    BACKENDS = ('mog2', 'tempdiff')
+
+    # MOG2 marks shadows as 127 and foreground as 255, so a single binary
+    # threshold above 127 drops shadows and noise in one pass
+    FOREGROUND_THRESHOLD = 244
+
+    def __init__(self, sensitivity='medium', min_contour_area=500, scale=0.25, backend='mog2',
+                 stride=3, use_cuda=True):
+        if backend not in self.BACKENDS:
+            logger.warning(f"Unknown motion backend '{backend}', using mog2")
+            backend = 'mog2'
+        self.backend = backend
+
+        # Run MOG2 and morphology on the GPU when OpenCV has CUDA support
+        self.use_cuda = use_cuda and backend == 'mog2' and CUDA_AVAILABLE
 
-    def __init__(self, sensitivity='medium', min_contour_area=500):
         self.enabled = False
         self.motion_detected = False
         self.last_motion_time = 0
@@ -24,16 +291,59 @@ class MotionDetector:
             'medium': 16,   # Balanced
             'high': 8       # More sensitive, may have more false positives
         }
-        var_threshold = sensitivity_map.get(sensitivity, 16)
+        self._var_threshold = sensitivity_map.get(sensitivity, 16)
 
-        # Initialize background subtractor
-        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(
-            history=500,
-            varThreshold=var_threshold,
-            detectShadows=True
-        )
+        # Sensitivity mapping to pixel difference threshold for tempdiff
+        diff_threshold_map = {
+            'low': 35,
+            'medium': 25,
+            'high': 15
+        }
+        self.diff_threshold = diff_threshold_map.get(sensitivity, 25)
 
         self.min_contour_area = min_contour_area
+
+        # Motion is detected on a downscaled copy of each frame
+        self.scale = scale
+        self._small = None
+
+        # Run detection on every Nth frame only
+        self.stride = max(1, stride)
+        self._frame_counter = 0
+        self._last_boxes = []
+
+        # Reused across frames to avoid per-frame allocations
+        self._kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        self._fg = None
+        self._fg2 = None
+        self._labels = None
+
+        # Grayscale history for tempdiff (current, previous, one before that)
+        self._gray = None
+        self._prev1 = None
+        self._prev2 = None
+        self._d1 = None
+        self._d2 = None
+
+        # Pre-render the motion indicator once; it is copied into frames via a mask.
+        # The mask is binarised so edge pixels aren't blended with the black tile
+        self._motion_label = np.zeros((40, 300, 3), dtype=np.uint8)
+        cv2.putText(self._motion_label, "MOTION DETECTED", (0, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2, cv2.LINE_8)
+        self._motion_label_mask = self._motion_label[:, :, 1:2] > 127
+        self._motion_label[:] = (0, 255, 0)
+
+        # GPU buffers and filters, reused across frames
+        if self.use_cuda:
+            try:
+                self._init_cuda()
+            except Exception as e:
+                logger.warning(f"CUDA motion detection unavailable, using CPU: {e}")
+                self.use_cuda = False
+
+        # Initialize background subtractor
+        self.bg_subtractor = self._create_bg_subtractor()
+
         self.lock = Lock()
 
     def detect_motion(self, frame):
@@ -53,48 +363,32 @@ class MotionDetector:
 
         try:
             with self.lock:
-                # Apply background subtraction
-                fg_mask = self.bg_subtractor.apply(frame)
+                # Only analyse every Nth frame; frames in between reuse the last boxes
+                if self._frame_counter % self.stride == 0:
+                    self._last_boxes = self._find_motion_boxes(frame)
 
-                # Remove shadows (set to 0)
-                fg_mask[fg_mask == 127] = 0
+                    # Update motion state
+                    if len(self._last_boxes):
+                        self.motion_detected = True
+                        self.last_motion_time = time.monotonic()
+                    else:
+                        # Keep motion_detected True for timeout period
+                        if time.monotonic() - self.last_motion_time > self.motion_timeout:
+                            self.motion_detected = False
+                self._frame_counter += 1
 
-                # Apply threshold to reduce noise
-                _, fg_mask = cv2.threshold(fg_mask, 244, 255, cv2.THRESH_BINARY)
+                # Nothing to draw, so skip copying the frame
+                if not self.motion_detected:
+                    return frame, False
 
-                # Morphological operations to reduce noise
-                kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-                fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, kernel)
-                fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_OPEN, kernel)
-
-                # Find contours
-                contours, _ = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-                # Filter contours by area and draw bounding boxes
-                motion_detected = False
+                # Draw bounding boxes and motion indicator overlay
                 annotated_frame = frame.copy()
+                for box in self._last_boxes:
+                    # Map bounding box back to full resolution
+                    x, y, w, h = (int(v / self.scale) for v in box)
+                    cv2.rectangle(annotated_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
 
-                for contour in contours:
-                    area = cv2.contourArea(contour)
-                    if area > self.min_contour_area:
-                        motion_detected = True
-                        # Draw bounding box
-                        x, y, w, h = cv2.boundingRect(contour)
-                        cv2.rectangle(annotated_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-
-                # Update motion state
-                if motion_detected:
-                    self.motion_detected = True
-                    self.last_motion_time = time.time()
-                else:
-                    # Keep motion_detected True for timeout period
-                    if time.time() - self.last_motion_time > self.motion_timeout:
-                        self.motion_detected = False
-
-                # Add motion indicator overlay
-                if self.motion_detected:
-                    cv2.putText(annotated_frame, "MOTION DETECTED", (10, 30),
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+                self._draw_motion_label(annotated_frame)
 
                 return annotated_frame, self.motion_detected
 
@@ -103,30 +397,203 @@ class MotionDetector:
             # Return original frame if motion detection fails
             return frame, False
 
+    def _find_motion_boxes(self, frame):
+        """Return bounding boxes (x, y, w, h) of motion regions, in downscaled coordinates"""
+        # Downscale, reusing the previous frame's buffer
+        self._small = cv2.resize(frame, None, dst=self._small, fx=self.scale, fy=self.scale,
+                                 interpolation=cv2.INTER_AREA)
+
+        # Build cleaned binary foreground mask in self._fg
+        if self.use_cuda:
+            self._background_subtraction_cuda(self._small)
+        else:
+            if self.backend == 'tempdiff':
+                self._temporal_difference(self._small)
+            else:
+                self._background_subtraction(self._small)
+
+            # Morphological operations to reduce noise
+            self._fg2 = cv2.morphologyEx(self._fg, cv2.MORPH_CLOSE, self._kernel, dst=self._fg2)
+            cv2.morphologyEx(self._fg2, cv2.MORPH_OPEN, self._kernel, dst=self._fg)
+
+        # Label connected regions, getting area and bounding box of each in one call
+        _, self._labels, stats, _ = cv2.connectedComponentsWithStats(
+            self._fg, self._labels, connectivity=8)
+
+        # Filter regions by area (min area is in full-resolution pixels), skipping background label 0
+        min_area = self.min_contour_area * self.scale ** 2
+        regions = stats[1:]
+        return regions[regions[:, cv2.CC_STAT_AREA] > min_area, :cv2.CC_STAT_AREA]
+
+    def _draw_motion_label(self, frame):
+        """Overlay the pre-rendered "MOTION DETECTED" label at the top left of frame"""
+        label_h, label_w = self._motion_label.shape[:2]
+        if frame.shape[0] < label_h or frame.shape[1] < label_w + 10:
+            cv2.putText(frame, "MOTION DETECTED", (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+            return
+
+        roi = frame[0:label_h, 10:10 + label_w]
+        np.copyto(roi, self._motion_label, where=self._motion_label_mask)
+
+    def _background_subtraction(self, small):
+        """Foreground mask from the MOG2 background model"""
+        self._fg = self.bg_subtractor.apply(small, self._fg)
+
+        # Remove shadows and reduce noise in a single pass
+        cv2.threshold(self._fg, self.FOREGROUND_THRESHOLD, 255, cv2.THRESH_BINARY, dst=self._fg)
+
+    def _init_cuda(self):
+        """Allocate GPU buffers and morphology filters"""
+        self._cuda_stream = cv2.cuda.Stream_Null()
+        self._gpu_small = cv2.cuda_GpuMat()
+        self._gpu_fg = cv2.cuda_GpuMat()
+        self._gpu_fg2 = cv2.cuda_GpuMat()
+        self._gpu_close = cv2.cuda.createMorphologyFilter(cv2.MORPH_CLOSE, cv2.CV_8UC1, self._kernel)
+        self._gpu_open = cv2.cuda.createMorphologyFilter(cv2.MORPH_OPEN, cv2.CV_8UC1, self._kernel)
+
+    def _background_subtraction_cuda(self, small):
+        """Cleaned foreground mask from MOG2 and morphology on the GPU"""
+        self._gpu_small.upload(small)
+        self._gpu_fg = self.bg_subtractor.apply(self._gpu_small, -1, self._cuda_stream, self._gpu_fg)
+
+        # Remove shadows and reduce noise in a single pass
+        cv2.cuda.threshold(self._gpu_fg, self.FOREGROUND_THRESHOLD, 255, cv2.THRESH_BINARY,
+                           self._gpu_fg)
+
+        # Morphological operations to reduce noise
+        self._gpu_close.apply(self._gpu_fg, self._gpu_fg2)
+        self._gpu_open.apply(self._gpu_fg2, self._gpu_fg)
+
+        # Only the small mask crosses back to the CPU, for region labelling
+        self._fg = self._gpu_fg.download(self._fg)
+
+    def _temporal_difference(self, small):
+        """Foreground mask from three-frame differencing"""
+        self._gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+        # Seed the history on the first frame (or after a resolution change)
+        if self._prev1 is None or self._prev1.shape != self._gray.shape:
+            self._prev1 = self._gray.copy()
+            self._prev2 = self._gray.copy()
+
+        # Pixels that changed in both of the last two frame pairs are moving;
+        # min(d1, d2) exceeds the threshold exactly when both differences do
+        self._d1 = cv2.absdiff(self._gray, self._prev1, dst=self._d1)
+        self._d2 = cv2.absdiff(self._prev1, self._prev2, dst=self._d2)
+        self._fg = cv2.min(self._d1, self._d2, dst=self._fg)
+        cv2.threshold(self._fg, self.diff_threshold, 255, cv2.THRESH_BINARY, dst=self._fg)
+
+        # Rotate history, recycling the oldest buffer for the next gray frame
+        self._prev2, self._prev1, self._gray = self._prev1, self._gray, self._prev2
+
+    def _create_bg_subtractor(self):
+        """Create a MOG2 background subtractor for the configured sensitivity"""
+        create = cv2.cuda.createBackgroundSubtractorMOG2 if self.use_cuda else cv2.createBackgroundSubtractorMOG2
+        return create(
+            history=500,
+            varThreshold=self._var_threshold,
+            detectShadows=True
+        )
+
     def set_enabled(self, enabled):
-        """Enable or disable motion detection"""
+        """Enable or disable motion detection, keeping the learned background model"""
         with self.lock:
             self.enabled = enabled
-            if enabled:
-                # Reset background model when enabling
-                self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(
-                    history=500,
-                    varThreshold=16,
-                    detectShadows=True
-                )
+
+    def reset_model(self):
+        """Discard the learned background model and frame history"""
+        with self.lock:
+            self.bg_subtractor = self._create_bg_subtractor()
+            self._prev1 = None
+            self._prev2 = None
+            self._last_boxes = []
 
     def is_motion_detected(self):
         """Check if motion is currently detected"""
         return self.motion_detected
 
 
+# Multipart envelope around each JPEG frame
+MJPEG_HEADER = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+MJPEG_FOOTER = b'\r\n'
+
+
+def jpeg_encode_param(jpeg_quality):
+    """Build cv2.imencode parameters for the given JPEG quality"""
+    return [int(cv2.IMWRITE_JPEG_QUALITY), int(jpeg_quality)]
+
+
+def encode_jpeg(frame, jpeg_quality, encode_param=None):
+    """
+    Encode a BGR frame as JPEG, returning the encoded buffer or None on failure
+
+    Args:
+        encode_param: Prebuilt jpeg_encode_param(jpeg_quality), to avoid rebuilding it per frame
+    """
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(frame, quality=jpeg_quality,
+                                 pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_420)
+
+    if encode_param is None:
+        encode_param = jpeg_encode_param(jpeg_quality)
+    ret, buffer = cv2.imencode('.jpg', frame, encode_param)
+    return buffer if ret else None
+
+
+def wrap_jpeg(buffer):
+    """Wrap an encoded JPEG buffer in the multipart envelope"""
+    # join reads straight from the encoder's buffer, avoiding a tobytes() copy.
+    # This runs once per captured frame and the result is shared by every viewer,
+    # so yielding header/payload/footer separately would only add per-viewer writes
+    return b''.join((MJPEG_HEADER, buffer, MJPEG_FOOTER))
+
+
+@functools.lru_cache(maxsize=8)
+def make_error_frame(message, jpeg_quality):
+    """Render a black multipart frame with an error message; cached as it only depends on the arguments"""
+    # Create black frame 640x480
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+
+    # Add text
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    text_size = cv2.getTextSize(message, font, 1, 2)[0]
+    text_x = (frame.shape[1] - text_size[0]) // 2
+    text_y = (frame.shape[0] + text_size[1]) // 2
+
+    cv2.putText(frame, message, (text_x, text_y), font, 1, (255, 255, 255), 2)
+
+    # Encode as JPEG
+    buffer = encode_jpeg(frame, jpeg_quality)
+
+    if buffer is not None:
+        return wrap_jpeg(buffer)
+    return b''
+
+
 class StreamHandler:
     """Handle RTSP stream capture and MJPEG conversion"""
     
     def __init__(self, rtsp_url, jpeg_quality=80, timeout=10, retry_interval=5,
-                 enable_motion_detection=False, motion_sensitivity='medium', motion_min_area=500):
+                 enable_motion_detection=False, motion_sensitivity='medium', motion_min_area=500,
+                 hw_decoder='none', motion_backend='mog2', motion_stride=3,
+                 motion_use_cuda=True, codec='h264', drop_frames=True, max_fps=None,
+                 capture_backend='opencv', target_width=None):
         self.rtsp_url = rtsp_url
+        self._safe_url = self._sanitize_url(rtsp_url)  # For log messages; the URL never changes
+        if capture_backend not in CAPTURE_BACKENDS:
+            logger.warning(f"Unknown capture backend '{capture_backend}', using opencv")
+            capture_backend = 'opencv'
+        if capture_backend == 'pyav' and av is None:
+            logger.warning("PyAV is not installed, using opencv capture backend")
+            capture_backend = 'opencv'
+        self.capture_backend = capture_backend
+        # PyAV always decodes in software
+        self.hw_decoder = resolve_hw_decoder(hw_decoder) if capture_backend == 'opencv' else None
+        self.codec = codec if codec in ('h264', 'h265') else 'h264'
         self.jpeg_quality = jpeg_quality
+        self._encode_param = jpeg_encode_param(jpeg_quality)
+        self.target_width = target_width  # Downscale wider frames before encoding (None to keep)
         self.timeout = timeout
         self.retry_interval = retry_interval
         self.cap = None
@@ -134,10 +601,30 @@ class StreamHandler:
         self.consecutive_failures = 0
         self.max_failures = 3
 
+        # Frames to skip with grab() when processing falls behind the source,
+        # or to keep output at max_fps (None for the source frame rate)
+        self.drop_frames = drop_frames
+        self.max_fps = max_fps
+        self.source_fps = 30
+        self.max_skipped_frames = 3
+        self._last_frame_time = 0
+
+        # Capture/encode producer thread, shared by all viewers
+        self.last_access = time.monotonic()
+        self._stop_event = Event()  # Set once by cleanup(); interrupts the producer's waits
+        self._producer = None
+        self._producer_lock = Lock()  # Separate from self.lock, which connect() holds while opening
+        self._frame_cond = Condition()
+        self._latest_frame = None
+        self._frame_seq = 0
+
         # Initialize motion detector
         self.motion_detector = MotionDetector(
             sensitivity=motion_sensitivity,
-            min_contour_area=motion_min_area
+            min_contour_area=motion_min_area,
+            backend=motion_backend,
+            stride=motion_stride,
+            use_cuda=motion_use_cuda
         )
         self.motion_detector.set_enabled(enable_motion_detection)
         
@@ -147,20 +634,46 @@ class StreamHandler:
             if self.cap is not None:
                 self.cap.release()
             
-            logger.info(f"Connecting to RTSP stream: {self._sanitize_url(self.rtsp_url)}")
-            self.cap = cv2.VideoCapture(self.rtsp_url)
-            
-            # Set buffer size to reduce latency
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-            
-            # Set timeout (in milliseconds)
-            self.cap.set(cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, self.timeout * 1000)
+            logger.info(f"Connecting to RTSP stream: {self._safe_url}")
+            self.cap = None
+
+            # PyAV can encode JPEGs without a BGR frame
+            if self.capture_backend == 'pyav':
+                self.cap = PyAVCapture(self.rtsp_url, self.timeout)
+            # Try hardware-accelerated decoding first
+            elif self.hw_decoder in FFMPEG_HW_DECODERS:
+                self.cap = open_ffmpeg_capture(self.rtsp_url, self.timeout,
+                                               FFMPEG_HW_DECODERS[self.hw_decoder])
+                if (self.cap.isOpened() and
+                        self.cap.get(cv2.CAP_PROP_HW_ACCELERATION) == cv2.VIDEO_ACCELERATION_NONE):
+                    logger.warning(f"No FFmpeg hardware device for '{self.hw_decoder}', "
+                                   f"decoding in software")
+            elif self.hw_decoder:
+                pipeline = build_gstreamer_pipeline(self.rtsp_url, self.hw_decoder, self.codec)
+                self.cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+
+            if self.hw_decoder and not self.cap.isOpened():
+                logger.warning(f"Hardware decoder '{self.hw_decoder}' failed, "
+                               f"falling back to software decoding")
+                self.cap.release()
+                self.cap = None
+
+            # Software decoding via FFmpeg
+            if self.cap is None:
+                self.cap = open_ffmpeg_capture(self.rtsp_url, self.timeout)
+
+                # Set buffer size to reduce latency
+                self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
             
             if not self.cap.isOpened():
-                logger.error(f"Failed to open stream: {self._sanitize_url(self.rtsp_url)}")
+                logger.error(f"Failed to open stream: {self._safe_url}")
                 return False
             
-            logger.info(f"Successfully connected to: {self._sanitize_url(self.rtsp_url)}")
+            # Some RTSP sources report 0 or nonsense, fall back to 30 fps
+            fps = self.cap.get(cv2.CAP_PROP_FPS)
+            self.source_fps = fps if 0 < fps <= 120 else 30
+
+            logger.info(f"Successfully connected to: {self._safe_url}")
             self.consecutive_failures = 0
             return True
             
@@ -180,108 +693,200 @@ class StreamHandler:
     
     def generate_frames(self):
         """Generate MJPEG frames from RTSP stream"""
-        last_reconnect_attempt = 0
-        
-        while True:
-            with self.lock:
+        self._start_producer()
+        last_seq = 0
+
+        while not self._stop_event.is_set():
+            # Wait for the producer to publish a frame we haven't sent yet
+            with self._frame_cond:
+                self._frame_cond.wait_for(
+                    lambda: self._frame_seq != last_seq or self._stop_event.is_set(), timeout=1.0)
+                frame, seq = self._latest_frame, self._frame_seq
+
+            if seq != last_seq:
+                last_seq = seq
+                self.touch()
+                yield frame
+
+    def touch(self):
+        """Record that a viewer is using this stream"""
+        self.last_access = time.monotonic()
+
+    def _start_producer(self):
+        """Start the capture thread if it isn't already running"""
+        with self._producer_lock:
+            # A cleaned-up handler may still be handed to a late viewer; don't reopen the camera
+            if self._stop_event.is_set():
+                return
+            if self._producer is None or not self._producer.is_alive():
+                self._producer = Thread(target=self._run, daemon=True)
+                self._producer.start()
+
+    def _publish(self, frame):
+        """Make an encoded multipart frame available to all viewers"""
+        with self._frame_cond:
+            self._latest_frame = frame
+            self._frame_seq += 1
+            self._frame_cond.notify_all()
+
+    def _run(self):
+        """Read, annotate and encode frames until stopped"""
+        last_reconnect_attempt = None
+        processing_time = 0
+
+        try:
+            while not self._stop_event.is_set():
                 # Try to connect if not connected
                 if self.cap is None or not self.cap.isOpened():
-                    current_time = time.time()
-                    if current_time - last_reconnect_attempt >= self.retry_interval:
-                        self.connect()
+                    current_time = time.monotonic()
+                    if (last_reconnect_attempt is None
+                            or current_time - last_reconnect_attempt >= self.retry_interval):
+                        with self.lock:
+                            self.connect()
                         last_reconnect_attempt = current_time
-                    
+
                     if self.cap is None or not self.cap.isOpened():
                         # Return a black frame when disconnected
-                        yield self._generate_error_frame("Connecting...")
-                        time.sleep(0.5)
+                        self._publish(self._generate_error_frame("Connecting..."))
+                        if self._stop_event.wait(0.5):
+                            return
                         continue
-                
+
                 try:
-                    success, frame = self.cap.read()
-                    
+                    # Motion overlays need a BGR frame; otherwise let PyAV encode from YUV
+                    direct_jpeg = (isinstance(self.cap, PyAVCapture)
+                                   and not self.motion_detector.enabled)
+                    success, frame = self._read_latest_frame(processing_time, direct_jpeg)
+                    frame_start = time.monotonic()
+
                     if not success or frame is None:
-                        self.consecutive_failures += 1
-                        logger.warning(f"Failed to read frame (failure {self.consecutive_failures}/{self.max_failures})")
-                        
-                        if self.consecutive_failures >= self.max_failures:
-                            logger.error("Max consecutive failures reached, reconnecting...")
-                            if self.cap is not None:
-                                self.cap.release()
-                                self.cap = None
-                            yield self._generate_error_frame("Connection lost")
-                            time.sleep(0.5)
-                            continue
-                        
-                        # Wait a bit before next attempt
-                        time.sleep(0.1)
+                        logger.warning(f"Failed to read frame (failure {self.consecutive_failures + 1}/{self.max_failures})")
+                        if self._stop_event.wait(self._record_failure()):
+                            return
                         continue
-                    
+
                     # Reset failure counter on success
                     self.consecutive_failures = 0
 
-                    # Apply motion detection if enabled
-                    if self.motion_detector.enabled:
-                        logger.debug("Applying motion detection to frame")
-                        frame, motion_detected = self.motion_detector.detect_motion(frame)
-                        logger.debug(f"Motion detection result: {motion_detected}")
-
-                    # Encode frame as JPEG
-                    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality]
-                    ret, buffer = cv2.imencode('.jpg', frame, encode_param)
-                    
-                    if not ret:
+                    if direct_jpeg:
+                        buffer = frame
+                    else:
+                        frame = self._resize_frame(frame)
+
+                        # Apply motion detection if enabled
+                        if self.motion_detector.enabled:
+                            logger.debug("Applying motion detection to frame")
+                            frame, motion_detected = self.motion_detector.detect_motion(frame)
+                            logger.debug(f"Motion detection result: {motion_detected}")
+
+                        # Encode frame as JPEG
+                        buffer = encode_jpeg(frame, self.jpeg_quality, self._encode_param)
+
+                    if buffer is None:
                         logger.error("Failed to encode frame")
                         continue
-                    
-                    # Convert to bytes and yield
-                    frame_bytes = buffer.tobytes()
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-                    
+
+                    self._publish(wrap_jpeg(buffer))
+                    processing_time = time.monotonic() - frame_start
+
                 except Exception as e:
                     logger.error(f"Error reading frame: {e}")
-                    self.consecutive_failures += 1
-                    time.sleep(0.1)
-    
+                    if self._stop_event.wait(self._record_failure()):
+                        return
+        finally:
+            with self.lock:
+                if self.cap is not None:
+                    self.cap.release()
+                    self.cap = None
+
+    def _record_failure(self):
+        """
+        Count a failed read or processing error, dropping the capture after max_failures in a row
+
+        Returns:
+            Seconds to wait before the next attempt
+        """
+        self.consecutive_failures += 1
+        if self.consecutive_failures < self.max_failures:
+            return 0.1
+
+        logger.error("Max consecutive failures reached, reconnecting...")
+        with self.lock:
+            if self.cap is not None:
+                self.cap.release()
+                self.cap = None
+        self._publish(self._generate_error_frame("Connection lost"))
+        return 0.5
+
+    def _read_latest_frame(self, processing_time, as_jpeg=False):
+        """
+        Read the next frame, skipping frames that arrived while the last one was processed
+        (when drop_frames is set) and frames beyond max_fps
+
+        Args:
+            as_jpeg: Return an encoded JPEG buffer from PyAVCapture.read_jpeg() instead of a BGR frame
+        """
+        # grab() only demuxes/decodes; retrieve() (inside read) does the costly BGR conversion
+        if self.drop_frames:
+            behind = min(int(processing_time * self.source_fps), self.max_skipped_frames)
+            for _ in range(behind):
+                if not self.cap.grab():
+                    return False, None
+
+        # Pace output to max_fps by discarding frames until the next one is due
+        if self.max_fps:
+            while time.monotonic() - self._last_frame_time < 1.0 / self.max_fps:
+                if not self.cap.grab():
+                    return False, None
+            self._last_frame_time = time.monotonic()
+
+        return self._read(as_jpeg)
+
+    def _read(self, as_jpeg):
+        """Read one frame from the capture, as a JPEG buffer or a BGR frame"""
+        if as_jpeg:
+            return self.cap.read_jpeg(self.jpeg_quality, self.target_width)
+        return self.cap.read()
+
+    def _resize_frame(self, frame):
+        """Downscale frames wider than target_width, keeping the aspect ratio"""
+        height, width = frame.shape[:2]
+        if not self.target_width or width <= self.target_width:
+            return frame
+        # Encode cost scales with pixel count; INTER_AREA avoids aliasing when shrinking
+        size = (self.target_width, self.target_width * height // width)
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
     def _generate_error_frame(self, message="No Signal"):
         """Generate a black frame with error message"""
-        import numpy as np
-        
-        # Create black frame 640x480
-        frame = np.zeros((480, 640, 3), dtype=np.uint8)
-        
-        # Add text
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        text_size = cv2.getTextSize(message, font, 1, 2)[0]
-        text_x = (frame.shape[1] - text_size[0]) // 2
-        text_y = (frame.shape[0] + text_size[1]) // 2
-        
-        cv2.putText(frame, message, (text_x, text_y), font, 1, (255, 255, 255), 2)
-        
-        # Encode as JPEG
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality]
-        ret, buffer = cv2.imencode('.jpg', frame, encode_param)
-        
-        if ret:
-            frame_bytes = buffer.tobytes()
-            return (b'--frame\r\n'
-                    b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        return b''
+        return make_error_frame(message, self.jpeg_quality)
     
     def set_motion_detection(self, enabled):
         """Enable or disable motion detection"""
         self.motion_detector.set_enabled(enabled)
-        logger.info(f"Motion detection {'enabled' if enabled else 'disabled'} for {self._sanitize_url(self.rtsp_url)}")
+        logger.info(f"Motion detection {'enabled' if enabled else 'disabled'} for {self._safe_url}")
 
     def is_motion_detected(self):
         """Check if motion is currently detected"""
         return self.motion_detector.is_motion_detected()
 
     def cleanup(self):
-        """Release resources"""
-        with self.lock:
-            if self.cap is not None:
-                self.cap.release()
-                self.cap = None
-                logger.info("Stream handler cleaned up")
+        """Stop the capture thread and release resources"""
+        # No lock here: connect() can hold self.lock for up to the open timeout,
+        # and _run checks the event at the top of every loop
+        self._stop_event.set()
+
+        # Wake any viewers waiting on a frame so they can exit
+        with self._frame_cond:
+            self._frame_cond.notify_all()
+
+        producer = self._producer
+        if producer is not None and producer.is_alive():
+            # The producer releases the capture itself on exit
+            producer.join(timeout=self.timeout)
+        else:
+            with self.lock:
+                if self.cap is not None:
+                    self.cap.release()
+                    self.cap = None
+        logger.info("Stream handler cleaned up")